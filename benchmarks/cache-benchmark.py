@@ -5,72 +5,150 @@ ChittyCan Cache Benchmark
 Measures cost savings and latency improvements from edge caching.
 Compares direct API calls vs ChittyCan proxy with caching enabled.
 
+The workload samples prompts from a pool with Zipf-distributed reuse, so
+the cache sees a realistic mix of hits and misses rather than one prompt
+repeated N times.
+
 Usage:
     export CHITTYCAN_TOKEN=chitty_xxx
-    python3 benchmarks/cache-benchmark.py
+    python3 benchmarks/cache-benchmark.py [--prompt-file prompts.txt] [--zipf-s 1.1]
 """
 
+import argparse
+import asyncio
 import os
+import random
 import sys
 import time
 import statistics
 import openai
-from typing import List, Tuple
+from typing import List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional; stats fall back to pure Python
+    np = None
 
 # Test configuration
 BENCHMARK_PROMPT = "What is the API endpoint for user authentication?"
 NUM_REQUESTS = 1000
+NUM_PROMPTS = 100  # Distinct prompts when no --prompt-file is given
+ZIPF_S = 1.1
+DIRECT_REQUESTS = 10  # Direct OpenAI is expensive, only replay a prefix
 CONCURRENCY = 10
 
 
-def run_benchmark(
+def load_prompts(prompt_file: Optional[str], num_prompts: int) -> List[str]:
+    """Load distinct prompts, one per line, most popular first"""
+    if prompt_file:
+        with open(prompt_file) as f:
+            prompts = list(dict.fromkeys(line.strip() for line in f if line.strip()))
+        if not prompts:
+            print(f"ERROR: No prompts found in {prompt_file}")
+            sys.exit(1)
+        return prompts
+
+    return [f"{BENCHMARK_PROMPT} (variant {i})" for i in range(num_prompts)]
+
+
+def sample_workload(
+    prompts: Sequence[str],
+    num_requests: int,
+    zipf_s: float,
+    seed: Optional[int] = None
+) -> List[str]:
+    """Draw a request stream where prompt k (1-based) has weight k ** -zipf_s"""
+    if np is not None:
+        weights = np.arange(1, len(prompts) + 1, dtype=np.float64) ** -zipf_s
+        rng = np.random.default_rng(seed)
+        idx = rng.choice(len(prompts), size=num_requests, p=weights / weights.sum())
+        return [prompts[i] for i in idx.tolist()]
+
+    weights = [k ** -zipf_s for k in range(1, len(prompts) + 1)]
+    return random.Random(seed).choices(prompts, weights=weights, k=num_requests)
+
+
+async def run_benchmark(
     api_base: str,
     api_key: str,
-    num_requests: int,
-    prompt: str
-) -> Tuple[List[float], float]:
+    prompts: Sequence[str]
+) -> Tuple[Sequence[float], Sequence[bool], float]:
     """
-    Run benchmark against specified API endpoint.
+    Run benchmark against specified API endpoint, one request per prompt.
+
+    Requests are issued concurrently, at most CONCURRENCY in flight. A
+    request counts as a cache hit when the proxy answers with
+    X-ChittyCan-Cache: HIT.
 
     Returns:
-        (latencies, total_cost)
+        (latencies, cache-hit flags, total_cost), both for completed requests
     """
-    openai.api_base = api_base
-    openai.api_key = api_key
-
-    latencies = []
-    total_tokens = 0
+    num_requests = len(prompts)
+    client = openai.AsyncOpenAI(base_url=api_base, api_key=api_key)
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    # Preallocated per-request results, indexed by request number
+    if np is not None:
+        latencies = np.empty(num_requests, dtype=np.float64)
+        tokens = np.zeros(num_requests, dtype=np.int64)
+        hit = np.zeros(num_requests, dtype=bool)
+        ok = np.zeros(num_requests, dtype=bool)
+    else:
+        latencies = [0.0] * num_requests
+        tokens = [0] * num_requests
+        hit = [False] * num_requests
+        ok = [False] * num_requests
+    completed = 0
 
     print(f"\nRunning {num_requests} requests...")
     print(f"Endpoint: {api_base}")
 
-    start_time = time.time()
+    async def worker(i: int):
+        nonlocal completed
+
+        async with semaphore:
+            # Start the clock once the slot is acquired so queueing
+            # behind the semaphore is not counted as request latency
+            request_start = time.perf_counter()
+
+            try:
+                raw = await client.chat.completions.with_raw_response.create(
+                    model="gpt-4",
+                    messages=[{"role": "user", "content": prompts[i]}],
+                    temperature=0  # Deterministic for caching
+                )
 
-    for i in range(num_requests):
-        request_start = time.time()
+                latencies[i] = time.perf_counter() - request_start
+                hit[i] = raw.headers.get("X-ChittyCan-Cache", "").upper() == "HIT"
+                response = raw.parse()
+                if response.usage:
+                    tokens[i] = response.usage.total_tokens
+                ok[i] = True
 
-        try:
-            response = openai.ChatCompletion.create(
-                model="gpt-4",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0  # Deterministic for caching
-            )
+            except Exception as e:
+                print(f"  Error on request {i + 1}: {e}")
+                return
 
-            request_latency = time.time() - request_start
-            latencies.append(request_latency)
+        # Progress indicator
+        completed += 1
+        if completed % 100 == 0:
+            print(f"  {completed}/{num_requests} requests complete...")
 
-            if response.usage:
-                total_tokens += response.usage.total_tokens
+    start_time = time.perf_counter()
 
-            # Progress indicator
-            if (i + 1) % 100 == 0:
-                print(f"  {i + 1}/{num_requests} requests complete...")
+    await asyncio.gather(*(worker(i) for i in range(num_requests)))
 
-        except Exception as e:
-            print(f"  Error on request {i + 1}: {e}")
-            continue
+    total_time = time.perf_counter() - start_time
 
-    total_time = time.time() - start_time
+    # Keep only completed requests; failed ones hold no tokens
+    if np is not None:
+        latencies = latencies[ok]
+        hit = hit[ok]
+        total_tokens = int(tokens.sum())
+    else:
+        latencies = [latency for latency, done in zip(latencies, ok) if done]
+        hit = [h for h, done in zip(hit, ok) if done]
+        total_tokens = sum(tokens)
 
     # Estimate cost (GPT-4: $0.03/1K input tokens, $0.06/1K output tokens)
     # Rough estimate: average split
@@ -79,17 +157,33 @@ def run_benchmark(
     print(f"\nCompleted {len(latencies)}/{num_requests} requests")
     print(f"Total time: {total_time:.2f}s")
 
-    return latencies, estimated_cost
+    return latencies, hit, estimated_cost
 
 
-def calculate_percentiles(latencies: List[float]) -> dict:
+def calculate_percentiles(latencies: Sequence[float]) -> dict:
     """Calculate latency percentiles"""
-    if not latencies:
+    if len(latencies) == 0:
         return {}
 
+    if np is not None:
+        arr = np.asarray(latencies, dtype=np.float64)
+        n = len(arr)
+
+        # Exact order statistics via quickselect, no full sort
+        k = [int(n * 0.5), int(n * 0.95), int(n * 0.99)]
+        part = np.partition(arr, k)
+        return {
+            "p50": float(part[k[0]]),
+            "p95": float(part[k[1]]),
+            "p99": float(part[k[2]]),
+            "min": float(arr.min()),
+            "max": float(arr.max()),
+            "avg": float(arr.mean())
+        }
+
     sorted_latencies = sorted(latencies)
     return {
-        "p50": statistics.median(sorted_latencies),
+        "p50": sorted_latencies[int(len(sorted_latencies) * 0.5)],
         "p95": sorted_latencies[int(len(sorted_latencies) * 0.95)],
         "p99": sorted_latencies[int(len(sorted_latencies) * 0.99)],
         "min": min(sorted_latencies),
@@ -98,7 +192,34 @@ def calculate_percentiles(latencies: List[float]) -> dict:
     }
 
 
-def print_results(name: str, latencies: List[float], cost: float):
+def split_hits(
+    latencies: Sequence[float],
+    hit: Sequence[bool]
+) -> Tuple[Sequence[float], Sequence[float]]:
+    """Split completed latencies into (hit, miss) by the proxy's cache header"""
+    if np is not None:
+        return latencies[hit], latencies[~hit]
+
+    hits = [latency for latency, h in zip(latencies, hit) if h]
+    misses = [latency for latency, h in zip(latencies, hit) if not h]
+    return hits, misses
+
+
+def print_hit_miss(hits: Sequence[float], misses: Sequence[float], ideal_hit_rate: float):
+    """Print measured hit rate and latency conditional on cache hit vs miss"""
+    total = len(hits) + len(misses)
+    print("\nCache (X-ChittyCan-Cache header):")
+    print(f"  Hit Rate:        {len(hits) / total * 100 if total else 0:.1f}%")
+    print(f"  Ideal Hit Rate:  {ideal_hit_rate * 100:.1f}% (first request per prompt misses)")
+    for label, group in (("Hit", hits), ("Miss", misses)):
+        if len(group):
+            p = calculate_percentiles(group)
+            print(f"  {label + ' P50/P95:':<17}{p['p50']*1000:.0f}ms / {p['p95']*1000:.0f}ms")
+        else:
+            print(f"  {label + ' P50/P95:':<17}n/a")
+
+
+def print_results(name: str, latencies: Sequence[float], cost: float):
     """Print benchmark results"""
     percentiles = calculate_percentiles(latencies)
 
@@ -116,8 +237,22 @@ def print_results(name: str, latencies: List[float], cost: float):
     print(f"  Max:             {percentiles['max']*1000:.0f}ms")
 
 
-def main():
+async def main():
     """Run cache benchmark comparison"""
+    parser = argparse.ArgumentParser(description="ChittyCan Cache Benchmark")
+    parser.add_argument("--prompt-file", help="File of distinct prompts, one per line, most popular first")
+    parser.add_argument("--num-prompts", type=int, default=NUM_PROMPTS, help="Synthetic prompt pool size without --prompt-file")
+    parser.add_argument("--requests", type=int, default=NUM_REQUESTS, help="Number of requests to send")
+    parser.add_argument("--zipf-s", type=float, default=ZIPF_S, help="Zipf exponent for prompt reuse")
+    parser.add_argument("--seed", type=int, help="Random seed for the sampled workload")
+    args = parser.parse_args()
+
+    prompts = load_prompts(args.prompt_file, args.num_prompts)
+    stream = sample_workload(prompts, args.requests, args.zipf_s, args.seed)
+    distinct = len(set(stream))
+    # Upper bound for any cache: every request after a prompt's first is a hit
+    ideal_hit_rate = 1 - distinct / len(stream) if stream else 0.0
+
     chittycan_token = os.environ.get("CHITTYCAN_TOKEN")
     openai_key = os.environ.get("OPENAI_API_KEY")
 
@@ -127,8 +262,9 @@ def main():
 
     print("ChittyCan Cache Benchmark")
     print("="*60)
-    print(f"Prompt: {BENCHMARK_PROMPT}")
-    print(f"Requests: {NUM_REQUESTS}")
+    print(f"Prompts: {len(prompts)} ({distinct} distinct in workload, Zipf s={args.zipf_s})")
+    print(f"Requests: {args.requests}")
+    print(f"Concurrency: {CONCURRENCY}")
     print(f"Model: gpt-4")
     print()
 
@@ -138,11 +274,10 @@ def main():
 
     if openai_key:
         print("\n[1/2] Benchmarking Direct OpenAI API...")
-        direct_latencies, direct_cost = run_benchmark(
+        direct_latencies, _, direct_cost = await run_benchmark(
             "https://api.openai.com/v1",
             openai_key,
-            10,  # Only 10 requests (expensive!)
-            BENCHMARK_PROMPT
+            stream[:DIRECT_REQUESTS]
         )
         print_results("Direct OpenAI", direct_latencies, direct_cost)
     else:
@@ -150,23 +285,26 @@ def main():
 
     # Benchmark 2: ChittyCan with cache
     print("\n[2/2] Benchmarking ChittyCan Proxy with Cache...")
-    chittycan_latencies, chittycan_cost = run_benchmark(
+    chittycan_latencies, chittycan_hit, chittycan_cost = await run_benchmark(
         "https://connect.chitty.cc/v1",
         chittycan_token,
-        NUM_REQUESTS,
-        BENCHMARK_PROMPT
+        stream
     )
     print_results("ChittyCan (with cache)", chittycan_latencies, chittycan_cost)
 
+    hit_latencies, miss_latencies = split_hits(chittycan_latencies, chittycan_hit)
+    print_hit_miss(hit_latencies, miss_latencies, ideal_hit_rate)
+    hit_rate = len(hit_latencies) / len(chittycan_latencies) if len(chittycan_latencies) else 0
+
     # Calculate savings
-    if direct_latencies:
+    if len(direct_latencies):
         direct_avg_cost = direct_cost / len(direct_latencies)
         chittycan_avg_cost = chittycan_cost / len(chittycan_latencies)
 
         cost_savings_pct = ((direct_avg_cost - chittycan_avg_cost) / direct_avg_cost) * 100
 
-        direct_avg_latency = statistics.mean(direct_latencies) * 1000
-        chittycan_avg_latency = statistics.mean(chittycan_latencies) * 1000
+        direct_avg_latency = calculate_percentiles(direct_latencies)["avg"] * 1000
+        chittycan_avg_latency = calculate_percentiles(chittycan_latencies)["avg"] * 1000
         latency_improvement_pct = ((direct_avg_latency - chittycan_avg_latency) / direct_avg_latency) * 100
 
         print(f"\n{'='*60}")
@@ -174,18 +312,25 @@ def main():
         print(f"{'='*60}")
         print(f"Cost Savings:      {cost_savings_pct:.1f}%")
         print(f"Latency Improved:  {latency_improvement_pct:.1f}%")
-        print(f"\nEstimated cache hit rate: {cost_savings_pct:.1f}%")
-        print(f"(Based on {NUM_REQUESTS} identical requests)")
+        print(f"\nMeasured cache hit rate: {hit_rate * 100:.1f}%")
+        print(f"Ideal cache hit rate:    {ideal_hit_rate * 100:.1f}%")
+        print(f"(Based on {args.requests} requests over {distinct} distinct prompts)")
 
     # Export for Prometheus/Grafana
     print(f"\n{'='*60}")
     print("PROMETHEUS METRICS")
     print(f"{'='*60}")
-    print(f"chitty_cache_hit_rate {chittycan_cost/direct_cost if direct_cost else 0:.2f}")
-    print(f"chitty_cost_per_request {{proxy='chittycan'}} {chittycan_cost/NUM_REQUESTS:.6f}")
+    print(f"chitty_cache_hit_rate {{proxy='chittycan'}} {hit_rate:.4f}")
+    print(f"chitty_benchmark_ideal_hit_rate {ideal_hit_rate:.4f}")
+    # Compare with chitty_hll_cardinality from the exporter for the same stream
+    print(f"chitty_benchmark_distinct_prompts {distinct}")
+    print(f"chitty_cost_per_request {{proxy='chittycan'}} {chittycan_cost/args.requests:.6f}")
     if direct_cost:
-        print(f"chitty_cost_per_request {{proxy='direct'}} {direct_cost/10:.6f}")
+        print(f"chitty_cost_per_request {{proxy='direct'}} {direct_cost/len(direct_latencies):.6f}")
     print(f"chitty_latency_p95_ms {{proxy='chittycan'}} {calculate_percentiles(chittycan_latencies)['p95']*1000:.0f}")
+    for label, group in (("hit", hit_latencies), ("miss", miss_latencies)):
+        if len(group):
+            print(f"chitty_latency_p95_ms {{proxy='chittycan',cache='{label}'}} {calculate_percentiles(group)['p95']*1000:.0f}")
 
     print(f"\n{'='*60}")
     print("✅ Benchmark Complete")
@@ -196,4 +341,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
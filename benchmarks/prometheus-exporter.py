@@ -10,22 +10,209 @@ Usage:
 """
 
 import argparse
+import bisect
+import gzip
+import hashlib
+import math
+import threading
 import time
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from typing import Dict, List
+from collections import Counter, defaultdict, deque
+from itertools import chain, count
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import DefaultDict, Deque, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional; only the bulk paths use it
+    np = None
+
+try:
+    from pytdigest import TDigest
+except ImportError:  # pytdigest is optional; the latency summary is skipped without it
+    TDigest = None
+
+# Histogram buckets: 0.01s, 0.1s, 0.5s, 1s, 2s, 5s, 10s, +Inf
+DURATION_BUCKETS = [0.01, 0.1, 0.5, 1.0, 2.0, 5.0, 10.0, float('inf')]
+BUCKET_LABELS = [str(b) for b in DURATION_BUCKETS[:-1]] + ["+Inf"]
+
+# Quantiles exported in the latency summary when pytdigest is available
+SUMMARY_QUANTILES = [0.5, 0.95, 0.99]
+
+# Durations buffered per model before one vectorized t-digest update
+DIGEST_BATCH = 256
+
+# Minimum seconds between rebuilds of the cached /metrics payload
+CACHE_TTL = 0.5
+
+
+def _family(name: str, help_text: str, metric_type: str, samples: Iterable[str]) -> bytes:
+    """Encode one metric family: blank separator line, HELP/TYPE header, then its samples"""
+    lines = chain(("", f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"), samples)
+    return ("\n".join(lines) + "\n").encode()
+
+
+def _fp(model: str, prompt: str) -> int:
+    """64-bit request fingerprint; blake2b is stable across processes and much cheaper than sha256"""
+    return int.from_bytes(hashlib.blake2b(f'{model}|{prompt}'.encode(), digest_size=8).digest(), 'little')
+
+
+def _accepts_gzip(accept_encoding: str) -> bool:
+    """Whether an Accept-Encoding header allows gzip; q=0 means the coding is refused"""
+    qualities = {}
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qualities[name.strip().lower()] = q
+
+    # An explicit gzip entry wins over the "*" wildcard
+    return qualities.get("gzip", qualities.get("*", 0.0)) > 0
+
+
+class HyperLogLog:
+    """HyperLogLog cardinality sketch with 2**p one-byte registers over 64-bit hashes"""
+
+    def __init__(self, p: int = 14):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m)
+
+    def add(self, h: int):
+        """Add a uniformly distributed 64-bit hash to the sketch"""
+        idx = h & (self.m - 1)
+        # Rank = position of the leftmost 1-bit in the remaining 64 - p bits
+        rank = (64 - self.p) - (h >> self.p).bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other: "HyperLogLog"):
+        """Merge another sketch into this one (register-wise max)"""
+        if np is not None:
+            regs = np.frombuffer(self.registers, dtype=np.uint8)
+            np.maximum(regs, np.frombuffer(other.registers, dtype=np.uint8), out=regs)
+        else:
+            self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def cardinality(self) -> float:
+        """Estimate the number of distinct items added"""
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        # Histogram of register values; at most 64 - p + 2 distinct ranks
+        inverse_sum = sum(self.registers.count(r) * 2.0 ** -r for r in set(self.registers))
+        estimate = alpha * self.m * self.m / inverse_sum
+
+        # Small-range correction (linear counting)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros:
+            estimate = self.m * math.log(self.m / zeros)
+        return estimate
+
+
+class SlidingHyperLogLog:
+    """
+    HyperLogLog over a sliding time window.
+
+    Keeps a ring of per-slot sketches plus a merged sketch of the whole
+    window. Adds update the current slot and the merged sketch; the
+    merged sketch is only rebuilt from the ring when the slot rotates.
+    """
+
+    def __init__(self, p: int = 14, slot_secs: int = 3600, window_secs: int = 86400):
+        self.p = p
+        self.slot_secs = slot_secs
+        self.num_slots = max(1, window_secs // slot_secs)
+
+        # (slot id, sketch, requests) per slot, oldest first
+        self.slots: Deque[Tuple[int, HyperLogLog, List[int]]] = deque()
+        self.window = HyperLogLog(p)
+        self.window_requests = 0
+
+    def _rotate(self, now: float):
+        slot_id = int(now // self.slot_secs)
+        if self.slots and self.slots[-1][0] == slot_id:
+            return
+
+        # Expire slots that fell out of the window and rebuild the merge
+        while self.slots and self.slots[0][0] <= slot_id - self.num_slots:
+            self.slots.popleft()
+        self.slots.append((slot_id, HyperLogLog(self.p), [0]))
+
+        self.window = HyperLogLog(self.p)
+        self.window_requests = 0
+        for _, sketch, requests in self.slots:
+            self.window.merge(sketch)
+            self.window_requests += requests[0]
+
+    def add(self, h: int, now: Optional[float] = None):
+        """Add a 64-bit hash to the current slot"""
+        self._rotate(time.monotonic() if now is None else now)
+        _, sketch, requests = self.slots[-1]
+        sketch.add(h)
+        self.window.add(h)
+        requests[0] += 1
+        self.window_requests += 1
+
+    def estimate(self, now: Optional[float] = None) -> Tuple[float, int]:
+        """Return (estimated distinct items, total items) over the window"""
+        self._rotate(time.monotonic() if now is None else now)
+        return self.window.cardinality(), self.window_requests
 
 
 class MetricsStore:
     """In-memory metrics storage"""
 
     def __init__(self):
-        self.requests_total: Dict[str, int] = {}
-        self.cache_hits_total: Dict[str, int] = {}
-        self.cache_requests_total: Dict[str, int] = {}
-        self.cost_cents_total: Dict[str, float] = {}
-        self.fallback_events_total: Dict[str, int] = {}
-        self.budget_overruns_total: Dict[str, int] = {}
-        self.request_duration_histogram: Dict[str, List[float]] = {}
+        self.requests_total: Counter[Tuple[str, str]] = Counter()
+        self.cache_hits_total: Counter[str] = Counter()
+        self.cache_requests_total: Counter[str] = Counter()
+        self.cost_cents_total: DefaultDict[Tuple[str, str], float] = defaultdict(float)
+        self.fallback_events_total: Counter[Tuple[str, str]] = Counter()
+        self.budget_overruns_total: Counter[str] = Counter()
+
+        # Streaming duration histogram: cumulative bucket counts per model as
+        # a list of ints (bisect beats numpy for single-sample updates), plus
+        # running sum/count and Welford's sum of squared deviations
+        self.bucket_counts: Dict[str, List[int]] = {}
+        self.duration_sum: DefaultDict[str, float] = defaultdict(float)
+        self.duration_count: Counter[str] = Counter()
+        self.duration_m2: DefaultDict[str, float] = defaultdict(float)
+
+        # Bounded-memory quantile sketch of durations per model. Single
+        # samples are buffered and folded in with one update per batch,
+        # since each pytdigest call has fixed wrapper overhead.
+        self.digests: Dict[str, "TDigest"] = {}
+        self._digest_pending: Dict[str, List[float]] = {}
+
+        # Distinct request fingerprints per model over the last 24h, used to
+        # estimate the hit rate an ideal cache would achieve
+        self.hll: Dict[str, SlidingHyperLogLog] = {}
+
+        # Per-model locks for record_request; one shared lock for the
+        # low-volume fallback and budget counters
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+        # Encoded export cached between scrapes. Every write draws a fresh
+        # generation number; the cache is rebuilt when it no longer matches.
+        self._generations = count(1)
+        self._last_generation = 0
+        self._cache_generation = -1
+        self._cache_time = 0.0
+        self._cached_chunks: Tuple[bytes, ...] = ()
+        self._cached_gzip: Optional[bytes] = None
+        self._cache_lock = threading.Lock()
+
+    def _model_lock(self, model: str) -> threading.Lock:
+        lock = self._locks.get(model)
+        if lock is None:
+            # setdefault is atomic, so racing first writers share one lock
+            lock = self._locks.setdefault(model, threading.Lock())
+        return lock
 
     def record_request(
         self,
@@ -33,119 +220,347 @@ class MetricsStore:
         tenant: str,
         duration: float,
         cached: bool,
-        cost: float
+        cost: float,
+        prompt: Optional[str] = None
     ):
         """Record a single request"""
-        key = f'{model},{tenant}'
-
-        # Increment request counter
-        self.requests_total[key] = self.requests_total.get(key, 0) + 1
-
-        # Record cache stats
-        self.cache_requests_total[model] = self.cache_requests_total.get(model, 0) + 1
-        if cached:
-            self.cache_hits_total[model] = self.cache_hits_total.get(model, 0) + 1
-
-        # Record cost
-        self.cost_cents_total[key] = self.cost_cents_total.get(key, 0.0) + cost
+        key = (model, tenant)
+
+        # All state touched below is keyed by model, so one lock per model
+        # serializes writers for that model without blocking the others
+        with self._model_lock(model):
+            # Increment request counter
+            self.requests_total[key] += 1
+
+            # Record cache stats
+            self.cache_requests_total[model] += 1
+            if cached:
+                self.cache_hits_total[model] += 1
+
+            # Record cost
+            self.cost_cents_total[key] += cost
+
+            # Record duration
+            counts = self.bucket_counts.get(model)
+            if counts is None:
+                counts = self.bucket_counts[model] = [0] * len(DURATION_BUCKETS)
+
+            # First bucket with bound >= duration, and every bucket above it
+            for idx in range(bisect.bisect_left(DURATION_BUCKETS, duration), len(counts)):
+                counts[idx] += 1
+
+            # Welford update: deviations from the mean before and after
+            n = self.duration_count[model]
+            old_mean = self.duration_sum[model] / n if n else 0.0
+            self.duration_sum[model] += duration
+            self.duration_count[model] = n + 1
+            new_mean = self.duration_sum[model] / (n + 1)
+            self.duration_m2[model] += (duration - old_mean) * (duration - new_mean)
+
+            if TDigest is not None:
+                pending = self._digest_pending.setdefault(model, [])
+                pending.append(duration)
+                if len(pending) >= DIGEST_BATCH:
+                    self._flush_digest(model)
+
+            # Record request fingerprint
+            if prompt is not None:
+                if model not in self.hll:
+                    self.hll[model] = SlidingHyperLogLog()
+                self.hll[model].add(_fp(model, prompt))
+
+        self._last_generation = next(self._generations)
+
+    def _digest(self, model: str) -> "TDigest":
+        """Get or create the model's t-digest; caller holds the model lock"""
+        if model not in self.digests:
+            self.digests[model] = TDigest()
+        return self.digests[model]
+
+    def _flush_digest(self, model: str):
+        """Fold buffered durations into the model's t-digest; caller holds the model lock"""
+        pending = self._digest_pending[model]
+        self._update_digest(model, np.asarray(pending, dtype=np.float64))
+        pending.clear()
+
+    def _update_digest(self, model: str, durations: "np.ndarray"):
+        """Vectorized t-digest update; caller holds the model lock"""
+        # pytdigest coerces size-1 arrays with float(), which numpy 2 rejects
+        if durations.size == 1:
+            self._digest(model).update(float(durations[0]))
+        else:
+            self._digest(model).update(durations)
 
-        # Record duration
-        if model not in self.request_duration_histogram:
-            self.request_duration_histogram[model] = []
-        self.request_duration_histogram[model].append(duration)
+    def record_bulk(
+        self,
+        models: Sequence[str],
+        tenants: Sequence[str],
+        durations: Sequence[float],
+        cached: Sequence[bool],
+        costs: Sequence[float],
+        prompts: Optional[Sequence[str]] = None
+    ):
+        """Record many requests at once; all arguments are parallel sequences"""
+        if np is None:
+            for i, args in enumerate(zip(models, tenants, durations, cached, costs)):
+                self.record_request(*args, prompts[i] if prompts is not None else None)
+            return
+
+        models = np.asarray(models)
+        tenants = np.asarray(tenants)
+        durations = np.asarray(durations, dtype=np.float64)
+        cached = np.asarray(cached, dtype=bool)
+        costs = np.asarray(costs, dtype=np.float64)
+        bucket_idx = np.searchsorted(DURATION_BUCKETS, durations, side='left')
+
+        for model in np.unique(models).tolist():
+            mask = models == model
+            n = int(mask.sum())
+
+            # Per-tenant request counts and cost sums in one pass each
+            tenant_names, inverse = np.unique(tenants[mask], return_inverse=True)
+            tenant_requests = np.bincount(inverse).tolist()
+            tenant_costs = np.bincount(inverse, weights=costs[mask]).tolist()
+
+            # Per-bucket sample counts, made cumulative before merging
+            bucket_hits = np.zeros(len(DURATION_BUCKETS), dtype=np.int64)
+            np.add.at(bucket_hits, bucket_idx[mask], 1)
+            cumulative = np.cumsum(bucket_hits).tolist()
+
+            hits = int(cached[mask].sum())
+            model_durations = durations[mask]
+            total_duration = float(model_durations.sum())
+            batch_mean = total_duration / n
+            batch_m2 = float(np.square(model_durations - batch_mean).sum())
+
+            with self._model_lock(model):
+                for tenant, requests, cost in zip(tenant_names.tolist(), tenant_requests, tenant_costs):
+                    key = (model, tenant)
+                    self.requests_total[key] += requests
+                    self.cost_cents_total[key] += cost
+
+                self.cache_requests_total[model] += n
+                if hits:
+                    self.cache_hits_total[model] += hits
+
+                counts = self.bucket_counts.get(model)
+                if counts is None:
+                    self.bucket_counts[model] = cumulative
+                else:
+                    for idx, bucket_count in enumerate(cumulative):
+                        counts[idx] += bucket_count
+                # Chan et al. merge of the batch into the running Welford state
+                prev_n = self.duration_count[model]
+                prev_mean = self.duration_sum[model] / prev_n if prev_n else 0.0
+                delta = batch_mean - prev_mean
+                self.duration_m2[model] += batch_m2 + delta * delta * prev_n * n / (prev_n + n)
+                self.duration_sum[model] += total_duration
+                self.duration_count[model] += n
+
+                if TDigest is not None:
+                    self._update_digest(model, model_durations)
+
+                if prompts is not None:
+                    if model not in self.hll:
+                        self.hll[model] = SlidingHyperLogLog()
+                    hll = self.hll[model]
+                    for i in np.flatnonzero(mask).tolist():
+                        hll.add(_fp(model, prompts[i]))
+
+        self._last_generation = next(self._generations)
+
+    def record_fallback(self, from_model: str, to_model: str):
+        """Record a provider fallback from one model to another"""
+        key = (from_model, to_model)
+        with self._lock:
+            self.fallback_events_total[key] += 1
+        self._last_generation = next(self._generations)
+
+    def record_budget_overrun(self, tenant: str):
+        """Record a budget overrun incident for a tenant"""
+        with self._lock:
+            self.budget_overruns_total[tenant] += 1
+        self._last_generation = next(self._generations)
+
+    def export_cached(self, compressed: bool = False) -> Tuple[bytes, ...]:
+        """
+        Encoded export chunks, rebuilt at most every CACHE_TTL seconds and
+        only after new writes. With compressed=True, returns a single gzip
+        chunk, compressed once per rebuild.
+        """
+        with self._cache_lock:
+            now = time.monotonic()
+            if self._cache_generation != self._last_generation and now - self._cache_time >= CACHE_TTL:
+                # Read the generation first: any write after this point
+                # leaves the cache stale and triggers the next rebuild
+                generation = self._last_generation
+                self._cached_chunks = tuple(self.iter_prometheus_lines())
+                self._cached_gzip = None
+                self._cache_generation = generation
+                self._cache_time = now
+
+            if not compressed:
+                return self._cached_chunks
+            if self._cached_gzip is None:
+                # Level 1: metrics text compresses well even at the fastest setting
+                self._cached_gzip = gzip.compress(b"".join(self._cached_chunks), compresslevel=1, mtime=0)
+            return (self._cached_gzip,)
 
     def export_prometheus(self) -> str:
         """Export metrics in Prometheus format"""
-        lines = []
-
-        # Header
-        lines.append("# ChittyCan Gateway Metrics")
-        lines.append("")
+        return b"".join(self.iter_prometheus_lines()).decode()
+
+    def iter_prometheus_lines(self) -> Iterator[bytes]:
+        """Yield the Prometheus export as encoded chunks, one per metric family"""
+        yield b"# ChittyCan Gateway Metrics\n"
+
+        # Writers may add keys while we export; list() snapshots each dict
+        # atomically. Histogram and HLL state is copied under the model lock
+        # so bucket counts, sum and count agree with each other.
+        histograms = []
+        summaries = []
+        estimates = []
+        for model, lock in list(self._locks.items()):
+            with lock:
+                counts = self.bucket_counts.get(model)
+                if counts is not None:
+                    histograms.append((
+                        model,
+                        counts[:],
+                        self.duration_sum[model],
+                        self.duration_count[model],
+                        self.duration_m2[model],
+                    ))
+                if self._digest_pending.get(model):
+                    self._flush_digest(model)
+                if model in self.digests:
+                    # Copy the centroids here; quantiles are queried on the
+                    # copy after the writers' lock is released
+                    digest = self.digests[model]
+                    summaries.append((
+                        model,
+                        TDigest.of_centroids(digest.get_centroids(), compression=digest.compression),
+                        self.duration_sum[model],
+                        self.duration_count[model],
+                    ))
+                if model in self.hll:
+                    estimates.append((model, *self.hll[model].estimate()))
 
         # Requests total
-        lines.append("# HELP chitty_requests_total Total number of requests")
-        lines.append("# TYPE chitty_requests_total counter")
-        for key, value in self.requests_total.items():
-            model, tenant = key.split(',')
-            lines.append(f'chitty_requests_total{{model="{model}",tenant="{tenant}"}} {value}')
-        lines.append("")
+        yield _family(
+            "chitty_requests_total", "Total number of requests", "counter",
+            (
+                f'chitty_requests_total{{model="{model}",tenant="{tenant}"}} {value}'
+                for (model, tenant), value in list(self.requests_total.items())
+            )
+        )
 
         # Cache hits
-        lines.append("# HELP chitty_cache_hits_total Total number of cache hits")
-        lines.append("# TYPE chitty_cache_hits_total counter")
-        for model, value in self.cache_hits_total.items():
-            lines.append(f'chitty_cache_hits_total{{model="{model}"}} {value}')
-        lines.append("")
+        yield _family(
+            "chitty_cache_hits_total", "Total number of cache hits", "counter",
+            (f'chitty_cache_hits_total{{model="{model}"}} {value}' for model, value in list(self.cache_hits_total.items()))
+        )
 
         # Cache requests
-        lines.append("# HELP chitty_cache_requests_total Total number of cacheable requests")
-        lines.append("# TYPE chitty_cache_requests_total counter")
-        for model, value in self.cache_requests_total.items():
-            lines.append(f'chitty_cache_requests_total{{model="{model}"}} {value}')
-        lines.append("")
+        yield _family(
+            "chitty_cache_requests_total", "Total number of cacheable requests", "counter",
+            (f'chitty_cache_requests_total{{model="{model}"}} {value}' for model, value in list(self.cache_requests_total.items()))
+        )
 
         # Cache hit rate (computed metric)
-        lines.append("# HELP chitty_cache_hit_rate Cache hit rate ratio (hits/requests)")
-        lines.append("# TYPE chitty_cache_hit_rate gauge")
-        for model in self.cache_requests_total.keys():
-            hits = self.cache_hits_total.get(model, 0)
-            requests = self.cache_requests_total[model]
-            rate = hits / requests if requests > 0 else 0
-            lines.append(f'chitty_cache_hit_rate{{model="{model}"}} {rate:.4f}')
-        lines.append("")
+        yield _family(
+            "chitty_cache_hit_rate", "Cache hit rate ratio (hits/requests)", "gauge",
+            (
+                f'chitty_cache_hit_rate{{model="{model}"}} {(self.cache_hits_total[model] / requests if requests > 0 else 0):.4f}'
+                for model, requests in list(self.cache_requests_total.items())
+            )
+        )
 
         # Cost in cents
-        lines.append("# HELP chitty_cost_cents_total Total cost in USD cents")
-        lines.append("# TYPE chitty_cost_cents_total counter")
-        for key, value in self.cost_cents_total.items():
-            model, tenant = key.split(',')
-            lines.append(f'chitty_cost_cents_total{{model="{model}",tenant="{tenant}"}} {value:.2f}')
-        lines.append("")
+        yield _family(
+            "chitty_cost_cents_total", "Total cost in USD cents", "counter",
+            (
+                f'chitty_cost_cents_total{{model="{model}",tenant="{tenant}"}} {value:.2f}'
+                for (model, tenant), value in list(self.cost_cents_total.items())
+            )
+        )
 
         # Request duration histogram
-        lines.append("# HELP chitty_request_duration_seconds Request duration in seconds")
-        lines.append("# TYPE chitty_request_duration_seconds histogram")
-        for model, durations in self.request_duration_histogram.items():
-            if not durations:
-                continue
-
-            sorted_durations = sorted(durations)
-            count = len(sorted_durations)
-
-            # Buckets: 0.01s, 0.1s, 0.5s, 1s, 2s, 5s, 10s, +Inf
-            buckets = [0.01, 0.1, 0.5, 1.0, 2.0, 5.0, 10.0, float('inf')]
-            cumulative = 0
-
-            for bucket in buckets:
-                cumulative += sum(1 for d in sorted_durations if d <= bucket)
-                bucket_label = "+Inf" if bucket == float('inf') else str(bucket)
-                lines.append(f'chitty_request_duration_seconds_bucket{{model="{model}",le="{bucket_label}"}} {cumulative}')
-
-            # Summary stats
-            total_duration = sum(durations)
-            lines.append(f'chitty_request_duration_seconds_sum{{model="{model}"}} {total_duration:.4f}')
-            lines.append(f'chitty_request_duration_seconds_count{{model="{model}"}} {count}')
-
-        lines.append("")
+        yield _family(
+            "chitty_request_duration_seconds", "Request duration in seconds", "histogram",
+            (
+                "\n".join(
+                    [
+                        f'chitty_request_duration_seconds_bucket{{model="{model}",le="{label}"}} {bucket_count}'
+                        for label, bucket_count in zip(BUCKET_LABELS, counts)
+                    ]
+                    + [
+                        f'chitty_request_duration_seconds_sum{{model="{model}"}} {total_duration:.4f}',
+                        f'chitty_request_duration_seconds_count{{model="{model}"}} {count}',
+                    ]
+                )
+                for model, counts, total_duration, count, _ in histograms
+            )
+        )
+
+        # Duration standard deviation (population) from the Welford state
+        yield _family(
+            "chitty_request_duration_stddev_seconds", "Standard deviation of request duration in seconds", "gauge",
+            (
+                f'chitty_request_duration_stddev_seconds{{model="{model}"}} {math.sqrt(m2 / count):.4f}'
+                for model, _, _, count, m2 in histograms
+            )
+        )
+
+        # Latency quantiles from the t-digest sketches
+        if summaries:
+            yield _family(
+                "chitty_request_latency_seconds", "Request duration quantiles in seconds", "summary",
+                (
+                    "\n".join(
+                        [
+                            f'chitty_request_latency_seconds{{model="{model}",quantile="{q}"}} {value:.4f}'
+                            for q, value in zip(SUMMARY_QUANTILES, digest.inverse_cdf(SUMMARY_QUANTILES).tolist())
+                        ]
+                        + [
+                            f'chitty_request_latency_seconds_sum{{model="{model}"}} {total_duration:.4f}',
+                            f'chitty_request_latency_seconds_count{{model="{model}"}} {count}',
+                        ]
+                    )
+                    for model, digest, total_duration, count in summaries
+                )
+            )
+
+        # Ideal-cache hit rate from distinct request fingerprints
+        if estimates:
+            yield _family(
+                "chitty_hll_cardinality", "Estimated distinct requests over the last 24h", "gauge",
+                (f'chitty_hll_cardinality{{model="{model}"}} {cardinality:.0f}' for model, cardinality, _ in estimates)
+            )
+            yield _family(
+                "chitty_hll_estimated_hit_rate", "Estimated hit rate of an ideal cache over the last 24h", "gauge",
+                (
+                    f'chitty_hll_estimated_hit_rate{{model="{model}"}} {(max(0.0, (total - cardinality) / total) if total > 0 else 0):.4f}'
+                    for model, cardinality, total in estimates
+                )
+            )
 
         # Fallback events
         if self.fallback_events_total:
-            lines.append("# HELP chitty_fallback_events_total Total number of provider fallback events")
-            lines.append("# TYPE chitty_fallback_events_total counter")
-            for key, value in self.fallback_events_total.items():
-                from_model, to_model = key.split('->')
-                lines.append(f'chitty_fallback_events_total{{from_model="{from_model}",to_model="{to_model}"}} {value}')
-            lines.append("")
+            yield _family(
+                "chitty_fallback_events_total", "Total number of provider fallback events", "counter",
+                (
+                    f'chitty_fallback_events_total{{from_model="{from_model}",to_model="{to_model}"}} {value}'
+                    for (from_model, to_model), value in list(self.fallback_events_total.items())
+                )
+            )
 
         # Budget overruns
         if self.budget_overruns_total:
-            lines.append("# HELP chitty_budget_overruns_total Total number of budget overrun incidents")
-            lines.append("# TYPE chitty_budget_overruns_total counter")
-            for tenant, value in self.budget_overruns_total.items():
-                lines.append(f'chitty_budget_overruns_total{{tenant="{tenant}"}} {value}')
-            lines.append("")
-
-        return "\n".join(lines)
+            yield _family(
+                "chitty_budget_overruns_total", "Total number of budget overrun incidents", "counter",
+                (f'chitty_budget_overruns_total{{tenant="{tenant}"}} {value}' for tenant, value in list(self.budget_overruns_total.items()))
+            )
 
 
 # Global metrics store
@@ -158,12 +573,20 @@ class MetricsHandler(BaseHTTPRequestHandler):
     def do_GET(self):
         """Handle GET requests"""
         if self.path == "/metrics":
+            use_gzip = _accepts_gzip(self.headers.get("Accept-Encoding", ""))
+            chunks = METRICS.export_cached(compressed=use_gzip)
+
             self.send_response(200)
             self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Vary", "Accept-Encoding")
+            if use_gzip:
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(sum(map(len, chunks))))
             self.end_headers()
 
-            metrics_output = METRICS.export_prometheus()
-            self.wfile.write(metrics_output.encode())
+            # One write per metric family; never joined into a single buffer
+            for chunk in chunks:
+                self.wfile.write(chunk)
 
         elif self.path == "/health":
             self.send_response(200)
@@ -182,21 +605,36 @@ class MetricsHandler(BaseHTTPRequestHandler):
 
 def generate_sample_data():
     """Generate sample metrics for testing"""
-    import random
-
     models = ["gpt-4", "claude-sonnet", "groq/llama-3-70b"]
     tenants = ["tenant-a", "tenant-b", "tenant-c"]
+    prompts = [f"sample prompt {i}" for i in range(100)]
+    n = 1000
 
     print("Generating sample metrics...")
 
-    for _ in range(1000):
-        model = random.choice(models)
-        tenant = random.choice(tenants)
-        duration = random.uniform(0.05, 2.0)
-        cached = random.random() < 0.7  # 70% cache hit rate
-        cost = 0 if cached else random.uniform(0.001, 0.05)
-
-        METRICS.record_request(model, tenant, duration, cached, cost)
+    if np is not None:
+        rng = np.random.default_rng()
+        cached = rng.random(n) < 0.7  # 70% cache hit rate
+        METRICS.record_bulk(
+            np.array(models)[rng.integers(0, len(models), n)],
+            np.array(tenants)[rng.integers(0, len(tenants), n)],
+            rng.uniform(0.05, 2.0, n),
+            cached,
+            np.where(cached, 0.0, rng.uniform(0.001, 0.05, n)),
+            [prompts[i] for i in rng.integers(0, len(prompts), n).tolist()]
+        )
+    else:
+        import random
+
+        for _ in range(n):
+            model = random.choice(models)
+            tenant = random.choice(tenants)
+            duration = random.uniform(0.05, 2.0)
+            cached = random.random() < 0.7  # 70% cache hit rate
+            cost = 0 if cached else random.uniform(0.001, 0.05)
+            prompt = random.choice(prompts)
+
+            METRICS.record_request(model, tenant, duration, cached, cost, prompt)
 
     print(f"Generated {sum(METRICS.requests_total.values())} sample requests")
 
@@ -211,7 +649,8 @@ def main():
     if args.sample_data:
         generate_sample_data()
 
-    server = HTTPServer(("", args.port), MetricsHandler)
+    # One thread per connection so a slow scrape never blocks /health
+    server = ThreadingHTTPServer(("", args.port), MetricsHandler)
 
     print(f"ChittyCan Prometheus Exporter")
     print(f"Listening on http://localhost:{args.port}/metrics")
@@ -11,20 +11,23 @@ Usage:
     python3 tests/parity_py.py
 """
 
+import asyncio
 import os
 import sys
 import time
 import openai
 
 # Configure
-openai.api_base = os.getenv("OPENAI_API_BASE", "https://connect.chitty.cc/v1")
-openai.api_key = os.environ.get("CHITTYCAN_TOKEN") or os.environ.get("OPENAI_API_KEY")
+api_base = os.getenv("OPENAI_API_BASE", "https://connect.chitty.cc/v1")
+api_key = os.environ.get("CHITTYCAN_TOKEN") or os.environ.get("OPENAI_API_KEY")
 
-if not openai.api_key:
+if not api_key:
     print("ERROR: Set CHITTYCAN_TOKEN or OPENAI_API_KEY")
     sys.exit(1)
 
-print(f"Testing OpenAI compatibility at: {openai.api_base}")
+client = openai.AsyncOpenAI(base_url=api_base, api_key=api_key)
+
+print(f"Testing OpenAI compatibility at: {api_base}")
 print("=" * 60)
 
 
@@ -35,11 +38,11 @@ def assert_ok(cond, msg):
         sys.exit(2)
 
 
-def test_chat():
+async def test_chat():
     """Test chat completions"""
     print("\n[1/5] Testing chat completions...")
 
-    r = openai.ChatCompletion.create(
+    r = await client.chat.completions.create(
         model="gpt-4",
         messages=[{"role": "user", "content": "Say hi in 3 words"}],
         max_tokens=16,
@@ -47,10 +50,10 @@ def test_chat():
     )
 
     # Verify response structure
-    assert_ok("id" in r, "chat missing id")
-    assert_ok("object" in r, "chat missing object")
-    assert_ok("choices" in r and r.choices, "chat missing choices")
-    assert_ok("usage" in r, "chat missing usage")
+    assert_ok(r.id, "chat missing id")
+    assert_ok(r.object == "chat.completion", "chat object type wrong")
+    assert_ok(r.choices, "chat missing choices")
+    assert_ok(r.usage, "chat missing usage")
 
     # Verify content
     content = r.choices[0].message.content
@@ -63,11 +66,11 @@ def test_chat():
     print("✓ Chat completions OK")
 
 
-def test_completion():
+async def test_completion():
     """Test text completions"""
     print("\n[2/5] Testing text completions...")
 
-    r = openai.Completion.create(
+    r = await client.completions.create(
         model="text-davinci-003",
         prompt="2+2 =",
         max_tokens=5,
@@ -75,8 +78,8 @@ def test_completion():
     )
 
     # Verify response structure
-    assert_ok("choices" in r and r.choices, "completion missing choices")
-    assert_ok("usage" in r, "completion missing usage")
+    assert_ok(r.choices, "completion missing choices")
+    assert_ok(r.usage, "completion missing usage")
 
     # Verify content
     text = r.choices[0].text
@@ -85,32 +88,34 @@ def test_completion():
     print("✓ Text completions OK")
 
 
-def test_embeddings():
-    """Test embeddings"""
+async def test_embeddings():
+    """Test batched embeddings"""
     print("\n[3/5] Testing embeddings...")
 
-    r = openai.Embedding.create(
+    inputs = ["hello world", "foo", "bar", "baz"]
+    r = await client.embeddings.create(
         model="text-embedding-3-small",
-        input="hello world"
+        input=inputs
     )
 
     # Verify response structure
-    assert_ok("data" in r and len(r.data) > 0, "embedding missing data")
-    assert_ok("object" in r, "embedding missing object")
+    assert_ok(r.object == "list", "embedding object type wrong")
+    assert_ok(len(r.data) == len(inputs), "embedding batch size mismatch")
 
-    # Verify embedding vector
-    embedding = r.data[0].embedding
-    assert_ok(len(embedding) > 100, "embedding vector too short")
-    assert_ok(isinstance(embedding[0], float), "embedding not float array")
+    # Verify embedding vectors, one per input in input order
+    for i, item in enumerate(r.data):
+        assert_ok(item.index == i, "embedding batch out of order")
+        assert_ok(len(item.embedding) > 100, "embedding vector too short")
+        assert_ok(isinstance(item.embedding[0], float), "embedding not float array")
 
     print("✓ Embeddings OK")
 
 
-def test_streaming():
+async def test_streaming():
     """Test streaming completions"""
     print("\n[4/5] Testing streaming...")
 
-    stream = openai.ChatCompletion.create(
+    stream = await client.chat.completions.create(
         model="gpt-4",
         messages=[{"role": "user", "content": "Count to 3"}],
         stream=True
@@ -119,14 +124,15 @@ def test_streaming():
     chunk_count = 0
     content = ""
 
-    for chunk in stream:
+    async for chunk in stream:
         chunk_count += 1
 
         # Verify chunk structure
-        assert_ok("choices" in chunk, "stream chunk missing choices")
+        assert_ok(chunk.object == "chat.completion.chunk", "stream chunk wrong object type")
+        assert_ok(chunk.choices, "stream chunk missing choices")
 
-        delta = chunk.choices[0].get("delta", {})
-        if "content" in delta:
+        delta = chunk.choices[0].delta
+        if delta.content:
             content += delta.content
 
     assert_ok(chunk_count > 0, "stream no chunks received")
@@ -135,43 +141,46 @@ def test_streaming():
     print("✓ Streaming OK")
 
 
-def test_error_handling():
+async def test_error_handling():
     """Test error handling"""
     print("\n[5/5] Testing error handling...")
 
     try:
-        openai.ChatCompletion.create(
+        await client.chat.completions.create(
             model="invalid-model-does-not-exist",
             messages=[{"role": "user", "content": "test"}]
         )
         assert_ok(False, "error handling should have raised exception")
-    except openai.error.OpenAIError as e:
+    except openai.OpenAIError:
         # Expected error
         assert_ok(True, "error handling raised correctly")
 
     print("✓ Error handling OK")
 
 
-def run_all():
-    """Run all tests"""
-    start_time = time.time()
+async def run_all():
+    """Run all tests concurrently"""
+    start_time = time.perf_counter()
 
-    test_chat()
-    test_completion()
-    test_embeddings()
-    test_streaming()
-    test_error_handling()
+    # Tests are independent, so total time is the slowest test, not the sum
+    await asyncio.gather(
+        test_chat(),
+        test_completion(),
+        test_embeddings(),
+        test_streaming(),
+        test_error_handling()
+    )
 
-    elapsed = time.time() - start_time
+    elapsed = time.perf_counter() - start_time
 
     print("\n" + "=" * 60)
     print(f"ALL TESTS PASSED ({elapsed:.2f}s)")
     print("\n✅ ChittyCan proxy is OpenAI-compatible")
     print("\nNext steps:")
-    print("  1. Update your code to use new api_base")
+    print("  1. Update your code to use new base_url")
     print("  2. Run your existing test suite")
     print("  3. Deploy to staging with new endpoint")
 
 
 if __name__ == "__main__":
-    run_all()
+    asyncio.run(run_all())